@@ -1,7 +1,7 @@
-import gradio as gr
 from rag_pipeline import RAGPipeline
 import os
 import sys
+import threading
 
 
 class RAGApp:
@@ -10,27 +10,45 @@ class RAGApp:
     def __init__(self):
         self.rag_pipeline = RAGPipeline()
         self.is_initialized = False
+        self._init_lock = threading.Lock()
+        
+        # Load models in the background so the UI can render immediately
+        self.ready_event = threading.Event()
+        threading.Thread(target=self._bg_init, daemon=True).start()
     
-    def initialize_pipeline(self):
-        if not self.is_initialized:
-            success = self.rag_pipeline.initialize()
-            if success:
-                self.is_initialized = True
-                return "✅ تم تهيئة النظام بنجاح"
-            else:
-                return "❌ فشل في تهيئة النظام"
-        return "✅ النظام مهيأ مسبقاً"
+    def _initialize(self) -> bool:
+        with self._init_lock:
+            if not self.is_initialized:
+                self.is_initialized = self.rag_pipeline.initialize()
+        return self.is_initialized
+    
+    def _bg_init(self):
+        try:
+            self._initialize()
+        finally:
+            self.ready_event.set()
+    
+    def initialize_pipeline(self, timeout: float = None):
+        if self.is_initialized:
+            return "✅ النظام مهيأ مسبقاً"
+        
+        # Wait for the background initialization, then retry once if it failed
+        if not self.ready_event.wait(timeout):
+            return "⏳ النظام قيد التهيئة، يرجى المحاولة بعد قليل"
+        
+        if self._initialize():
+            return "✅ تم تهيئة النظام بنجاح"
+        return "❌ فشل في تهيئة النظام"
     
     def initialize_on_load(self):
-        if not self.is_initialized:
-            self.rag_pipeline.initialize()
-            self.is_initialized = True
+        # Initialization already runs in the background thread started in __init__
+        return
     
     def answer_question(self, question: str):
         if not self.is_initialized:
-            init_msg = self.initialize_pipeline()
-            if "فشل" in init_msg:
-                return "", "يرجى تهيئة النظام أولاً"
+            init_msg = self.initialize_pipeline(timeout=60)
+            if not self.is_initialized:
+                return "", init_msg if "⏳" in init_msg else "يرجى تهيئة النظام أولاً"
         
         if not question.strip():
             return "", "يرجى إدخال سؤال"
@@ -46,7 +64,31 @@ class RAGApp:
         
         return result['answer'], ""
     
+    def answer_question_stream(self, question: str):
+        if not self.is_initialized:
+            init_msg = self.initialize_pipeline(timeout=60)
+            if not self.is_initialized:
+                yield "", init_msg if "⏳" in init_msg else "يرجى تهيئة النظام أولاً"
+                return
+        
+        if not question.strip():
+            yield "", "يرجى إدخال سؤال"
+            return
+        
+        # Yield the answer accumulated so far as each chunk arrives
+        answer = ""
+        for chunk in self.rag_pipeline.answer_question_stream(
+            question=question,
+            top_k=3,
+            temperature=0.7
+        ):
+            answer += chunk
+            yield answer, ""
+    
     def create_interface(self):
+        # Imported here so the CLI does not pay for Gradio's startup cost
+        import gradio as gr
+        
         # Enhanced CSS for better Arabic UI
         custom_css = """
         .rtl { 
@@ -182,13 +224,16 @@ class RAGApp:
                         )
             
             # Event handlers
-            def handle_submit(question):
-                answer, error = self.answer_question(question)
+            def handle_submit(question, progress=gr.Progress()):
+                if not self.ready_event.is_set():
+                    progress(0, desc="جاري تهيئة النظام...")
                 
-                if error:
-                    return f"❌ خطأ: {error}", gr.update(visible=False, value="")
-                else:
-                    return answer, gr.update(visible=False, value="")
+                # Generator callback so Gradio renders tokens as they arrive
+                for answer, error in self.answer_question_stream(question):
+                    if error:
+                        yield f"❌ خطأ: {error}", gr.update(visible=False, value="")
+                    else:
+                        yield answer, gr.update(visible=False, value="")
             
             submit_btn.click(
                 handle_submit,
@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import json
 from typing import List, Dict, Any
@@ -17,11 +18,12 @@ def load_dataset(file_path: str = None) -> pd.DataFrame:
     if file_path is None:
         file_path = "sample_arabic_dataset.json"
     
-    if pd.io.common.file_exists(file_path):
-        if file_path.endswith('.csv'):
+    if os.path.exists(file_path):
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension == '.csv':
             df = pd.read_csv(file_path)
-        elif file_path.endswith('.json'):
-            df = pd.read_json(file_path)
+        elif extension == '.json':
+            df = pd.read_json(file_path, orient='records')
         else:
             raise ValueError("Unsupported file format. Use CSV or JSON.")
     else:
@@ -55,10 +57,8 @@ def preprocess_text(text: str) -> str:
     return text
 
 def prepare_contexts_for_embedding(df: pd.DataFrame) -> List[str]:
-    contexts = []
-    for _, row in df.iterrows():
-        context = preprocess_text(row['context'])
-        contexts.append(context)
+    # Walk the column as a plain list; no per-row Series like iterrows(), and faster than Series.map
+    contexts = [preprocess_text(text) for text in df['context'].tolist()]
     
     return contexts
 
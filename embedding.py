@@ -2,29 +2,145 @@ import torch
 import numpy as np
 from transformers import AutoTokenizer, AutoModel
 import faiss
-import pickle
+import ollama
+import pyarrow as pa
 import os
-from typing import List, Tuple
+import hashlib
+import threading
+from typing import List, Tuple, Optional
 from data_preparation import load_dataset, prepare_contexts_for_embedding
 
+class MappedContexts:
+    """Read-only list of contexts backed by a memory-mapped Arrow IPC file.
+
+    Strings stay in the mapped buffer and are converted to Python only when accessed.
+    """
+    
+    __slots__ = ('_array',)
+    
+    def __init__(self, path: str):
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        # combine_chunks() would copy the strings onto the heap; index the mapped chunks in place
+        column = table.column('context')
+        self._array = column.chunk(0) if column.num_chunks == 1 else column
+    
+    def __len__(self) -> int:
+        return len(self._array)
+    
+    def __getitem__(self, idx: int) -> str:
+        return self._array[idx].as_py()
+    
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
 class ArabicEmbedding: 
-    def __init__(self, model_name: str = "aubmindlab/bert-base-arabertv2"):
+    def __init__(self, 
+                 model_name: str = "aubmindlab/bert-base-arabertv2", 
+                 batch_size: Optional[int] = None, 
+                 use_fp16: Optional[bool] = None, 
+                 backend: str = "eager", 
+                 gpu_index_fp16: bool = True, 
+                 onnx_dir: str = os.path.join("embeddings", "onnx")):
+        if backend not in ("eager", "compile", "onnx"):
+            raise ValueError(f"Unsupported backend: {backend}")
+        
         self.model_name = model_name
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.batch_size = batch_size or (32 if self.device.type == "cuda" else 8)
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        # Half precision only pays off on GPU tensor cores
+        self.use_fp16 = self.device.type == "cuda" and use_fp16 is not False and backend != "onnx"
         self.tokenizer = None
         self.model = None
+        self._load_lock = threading.Lock()
         self.index = None
         self.contexts = None
+        # Keep the FAISS index on GPU when a GPU build of FAISS sees a device
+        self.use_gpu_index = faiss.get_num_gpus() > 0
+        # Store GPU vectors / PQ lookup tables in FP16; queries stay FP32
+        self.gpu_index_fp16 = gpu_index_fp16
+        self._gpu_resources = None
+        self.index_on_gpu = False
+        # Full-precision host copy of a GPU index, so saving never persists FP16-rounded vectors
+        self._host_index = None
+        # GPU indexes and their shared StandardGpuResources are not thread-safe, even for search
+        self._search_lock = threading.Lock()
         
+    @property
+    def outputs_normalized(self) -> bool:
+        # Every vector encode_text/encode_texts return is L2-normalized, so neither query
+        # nor document vectors need another faiss.normalize_L2 pass
+        return True
+    
+    def _ensure_model_loaded(self) -> None:
+        # Concurrent callers (e.g. batch answering) must not load the model twice
+        if self.model is None or self.tokenizer is None:
+            with self._load_lock:
+                if self.model is None or self.tokenizer is None:
+                    self.load_model()
+    
     def load_model(self) -> None:
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-        self.model = AutoModel.from_pretrained(self.model_name)
-        self.model.to(self.device)
-        self.model.eval()
+        
+        if self.backend == "onnx":
+            model = self._load_onnx_model()
+        else:
+            # The pooler head is unused since sentence vectors are mean-pooled
+            model = AutoModel.from_pretrained(self.model_name, add_pooling_layer=False)
+            model.to(self.device)
+            if self.use_fp16:
+                model.half()
+            model.eval()
+            
+            # Kernel fusion and less Python overhead; the first calls pay compilation
+            if self.backend == "compile" and hasattr(torch, "compile"):
+                model = torch.compile(model, mode="reduce-overhead", dynamic=True)
+        
+        # Publish only once fully prepared, since other threads check self.model
+        self.model = model
+    
+    def _load_onnx_model(self):
+        # Imported here since optimum is only needed for the ONNX backend
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        
+        provider = "CUDAExecutionProvider" if self.device.type == "cuda" else "CPUExecutionProvider"
+        export_dir = os.path.join(self.onnx_dir, self.model_name.replace("/", "--"))
+        
+        # Export once and reuse the cached .onnx graph afterwards
+        if os.path.exists(os.path.join(export_dir, "model.onnx")):
+            return ORTModelForFeatureExtraction.from_pretrained(export_dir, provider=provider)
+        
+        model = ORTModelForFeatureExtraction.from_pretrained(self.model_name, export=True, provider=provider)
+        model.save_pretrained(export_dir)
+        return model
+    
+    def warm_up(self) -> None:
+        # Load (and compile) the model up front so the first question does not pay for it
+        self.encode_text("تهيئة")
+    
+    def _forward(self, inputs: dict) -> np.ndarray:
+        # Move to device
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        
+        # Generate embeddings
+        with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.float16, enabled=self.use_fp16):
+            hidden = self.model(**inputs).last_hidden_state
+            
+            # Mean-pool over real tokens only, ignoring padding
+            mask = inputs['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+            embeddings = (hidden * mask).sum(1) / mask.sum(1).clamp(min=1)
+            
+            # L2-normalize on device; cast back to FP32 so the FAISS index math stays in full precision
+            embeddings = torch.nn.functional.normalize(embeddings.float(), dim=-1)
+        
+        return embeddings.cpu().numpy()
     
     def encode_text(self, text: str) -> np.ndarray:
-        if self.model is None or self.tokenizer is None:
-            self.load_model()
+        # Returns a C-contiguous float32 array of shape (1, d), ready for FAISS as-is
+        self._ensure_model_loaded()
             
         # Tokenize and encode
         inputs = self.tokenizer(
@@ -35,96 +151,281 @@ class ArabicEmbedding:
             max_length=512
         )
         
-        # Move to device
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
-        
-        # Generate embeddings
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            # Use the [CLS] token embedding as the sentence representation
-            embeddings = outputs.last_hidden_state[:, 0, :].cpu().numpy()
+        embeddings = self._forward(inputs)
             
-        return embeddings.flatten()
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
     
-    def encode_texts(self, texts: List[str], batch_size: int = 8) -> np.ndarray:
-        if self.model is None or self.tokenizer is None:
-            self.load_model()
-            
-        all_embeddings = []
+    def _embedding_cache_key(self, text: str) -> str:
+        # The pooling tag keeps vectors from other pooling strategies from being reused
+        return hashlib.sha256((self.model_name + "\x00mean\x00" + text).encode('utf-8')).hexdigest()
+    
+    def encode_texts(self, 
+                     texts: List[str], 
+                     batch_size: Optional[int] = None, 
+                     cache_dir: Optional[str] = None, 
+                     use_cache: bool = True) -> np.ndarray:
+        # Look up previously computed vectors by content hash
+        embeddings = [None] * len(texts)
+        keys = [self._embedding_cache_key(text) for text in texts] if cache_dir else None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            if use_cache:
+                for i, key in enumerate(keys):
+                    cache_file = os.path.join(cache_dir, key + ".npy")
+                    if os.path.exists(cache_file):
+                        embeddings[i] = np.load(cache_file)
+        
+        missing_idx = [i for i, emb in enumerate(embeddings) if emb is None]
+        if missing_idx:
+            missing_embeddings = self._embed_batches([texts[i] for i in missing_idx], batch_size or self.batch_size)
+            for i, embedding in zip(missing_idx, missing_embeddings):
+                embeddings[i] = embedding
+                if cache_dir:
+                    np.save(os.path.join(cache_dir, keys[i] + ".npy"), embedding)
         
-        for i in range(0, len(texts), batch_size):
-            batch_texts = texts[i:i + batch_size]
+        # Assemble the full matrix in input order
+        embeddings_matrix = np.vstack(embeddings)
+        
+        return embeddings_matrix
+    
+    def _embed_batches(self, texts: List[str], batch_size: int) -> np.ndarray:
+        self._ensure_model_loaded()
+        
+        # Tokenize once without padding, then batch texts of similar length
+        # together so each batch is only padded to its own longest sequence
+        encodings = self.tokenizer(
+            texts,
+            truncation=True,
+            max_length=512
+        )
+        lengths = np.array([len(ids) for ids in encodings['input_ids']])
+        order = np.argsort(lengths, kind='stable')
+        
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            bucket = order[start:start + batch_size]
             
-            # Tokenize batch
-            inputs = self.tokenizer(
-                batch_texts,
-                return_tensors="pt",
-                truncation=True,
-                padding=True,
-                max_length=512
+            # Pad the bucket to its longest sequence
+            inputs = self.tokenizer.pad(
+                [{key: encodings[key][j] for key in encodings.keys()} for j in bucket],
+                padding='longest',
+                return_tensors="pt"
             )
             
-            # Move to device
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            
-            # Generate embeddings
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                # Use the [CLS] token embedding as the sentence representation
-                batch_embeddings = outputs.last_hidden_state[:, 0, :].cpu().numpy()
-                
-            all_embeddings.append(batch_embeddings)
-        
-        # Concatenate all embeddings
-        embeddings_matrix = np.vstack(all_embeddings)
+            batches.append(self._forward(inputs))
         
-        return embeddings_matrix
+        # Scatter back to input order
+        return np.vstack(batches)[np.argsort(order)]
     
-    def build_faiss_index(self, embeddings: np.ndarray) -> None:
-        dimension = embeddings.shape[1]
+    def build_faiss_index(self, 
+                          embeddings: np.ndarray, 
+                          index_type: str = "auto", 
+                          refine: bool = False, 
+                          normalized: bool = False) -> None:
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        num_vectors, dimension = embeddings.shape
         
-        # Create FAISS index (using IndexFlatIP for cosine similarity)
-        self.index = faiss.IndexFlatIP(dimension)
+        # Normalize embeddings so inner product equals cosine similarity, once, at build time
+        if not normalized:
+            faiss.normalize_L2(embeddings)
         
-        # Normalize embeddings for cosine similarity
-        faiss.normalize_L2(embeddings)
+        if index_type == "auto":
+            if num_vectors <= 2000:
+                index_type = "flat"
+            elif num_vectors < 200000:
+                index_type = "hnsw"
+            else:
+                index_type = "ivfpqfs"
         
-        # Add embeddings to index
-        self.index.add(embeddings.astype(np.float32))
+        if index_type == "flat":
+            # Exact search; brute force is fastest for small corpora
+            self.index = faiss.IndexFlatIP(dimension)
+        elif index_type == "sq8":
+            # Exact scan over 8-bit scalar-quantized vectors: 4x smaller than flat, minor recall loss
+            self.index = faiss.IndexScalarQuantizer(
+                dimension, 
+                faiss.ScalarQuantizer.QT_8bit, 
+                faiss.METRIC_INNER_PRODUCT
+            )
+            self.index.train(embeddings)
+        elif index_type == "hnsw":
+            # Graph-based approximate search, sublinear per query
+            self.index = faiss.IndexHNSWFlat(dimension, 32, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efConstruction = 200
+            self.index.hnsw.efSearch = 64
+        elif index_type == "ivfpq":
+            # Inverted lists over product-quantized codes for very large corpora
+            num_subquantizers = 64
+            while dimension % num_subquantizers:
+                num_subquantizers //= 2
+            self.index = faiss.index_factory(
+                dimension, 
+                f"IVF4096,PQ{num_subquantizers}", 
+                faiss.METRIC_INNER_PRODUCT
+            )
+            self.index.train(embeddings)
+        elif index_type == "ivfpqfs":
+            # 4-bit PQ codes scanned with SIMD lookup tables (32 bytes/vector with 64 subquantizers)
+            num_subquantizers = 64
+            while dimension % num_subquantizers:
+                num_subquantizers //= 2
+            nlist = max(1, int(4 * np.sqrt(num_vectors)))
+            self.index = faiss.index_factory(
+                dimension, 
+                f"IVF{nlist},PQ{num_subquantizers}x4fs", 
+                faiss.METRIC_INNER_PRODUCT
+            )
+            self.index.train(embeddings)
+        else:
+            raise ValueError(f"Unsupported index type: {index_type}")
+        
+        self._set_search_params()
+        
+        if refine and index_type != "flat":
+            # Re-rank a wider approximate candidate list with exact inner products
+            self.index = faiss.IndexRefineFlat(self.index)
+            self.index.k_factor = 10
+        
+        # Add embeddings with explicit ids so search results map to stable context rows
+        self.index = faiss.IndexIDMap2(self.index)
+        self.index.add_with_ids(embeddings, np.arange(num_vectors, dtype=np.int64))
+        
+        self._move_index_to_gpu()
+    
+    def _set_search_params(self) -> None:
+        # Probe enough inverted lists for good recall; non-IVF indexes have nothing to set
+        try:
+            ivf = faiss.extract_index_ivf(self.index)
+        except RuntimeError:
+            return
+        ivf.nprobe = max(8, ivf.nlist // 32)
+    
+    def _move_index_to_gpu(self) -> None:
+        self.index_on_gpu = False
+        self._host_index = None
+        if not self.use_gpu_index:
+            return
+        
+        try:
+            if self._gpu_resources is None:
+                self._gpu_resources = faiss.StandardGpuResources()
+            
+            # Halves memory bandwidth and enables tensor-core distance computation
+            cloner_options = faiss.GpuClonerOptions()
+            cloner_options.useFloat16 = self.gpu_index_fp16
+            gpu_index = faiss.index_cpu_to_gpu(self._gpu_resources, 0, self.index, cloner_options)
+            self._host_index, self.index = self.index, gpu_index
+            self.index_on_gpu = True
+        except (RuntimeError, AttributeError):
+            # Some index types (e.g. HNSW) have no GPU implementation; search on CPU instead
+            pass
+    
+    def search(self, query_embeddings: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Serialize searches on GPU; CPU indexes are safe to search concurrently
+        if self.index_on_gpu:
+            with self._search_lock:
+                return self.index.search(query_embeddings, top_k)
+        return self.index.search(query_embeddings, top_k)
+    
+    def _cpu_index(self) -> faiss.Index:
+        # Copying the GPU index back would return FP16-rounded vectors; use the host original
+        if self.index_on_gpu:
+            return self._host_index
+        return self.index
     
     def save_index_and_contexts(self, index_path: str, contexts_path: str, contexts: List[str]) -> None:
-        # Save FAISS index
-        faiss.write_index(self.index, index_path)
+        # Save FAISS index; GPU indexes are saved from their full-precision host copy
+        faiss.write_index(self._cpu_index(), index_path)
         
-        # Save contexts
-        with open(contexts_path, 'wb') as f:
-            pickle.dump(contexts, f)
+        # Save contexts as a single-column Arrow file; row i holds the context with FAISS id i
+        # large_string has 64-bit offsets, so corpora past 2 GiB still fit in one array (one mapped chunk)
+        table = pa.table({'context': pa.array(contexts, type=pa.large_string())})
+        with pa.OSFile(contexts_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
         
-        self.contexts = contexts
+        # Serve from the mapped file too, so the build worker shares page cache instead of holding the list
+        self.contexts = MappedContexts(contexts_path)
     
     def load_index_and_contexts(self, index_path: str, contexts_path: str) -> None:
-        # Load FAISS index
-        self.index = faiss.read_index(index_path)
+        # Document vectors were normalized once at build time and are stored unit-length,
+        # so nothing is re-normalized here; only queries need normalizing before search
+        
+        # Load FAISS index, memory-mapped where the index type supports it
+        try:
+            self.index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            self.index = faiss.read_index(index_path)
         
-        # Load contexts
-        with open(contexts_path, 'rb') as f:
-            self.contexts = pickle.load(f)
+        self._set_search_params()
+        self._move_index_to_gpu()
+        
+        # Map contexts lazily instead of decoding them all up front
+        self.contexts = MappedContexts(contexts_path)
     
-    def create_embeddings_and_index(self, contexts: List[str], save_dir: str = "embeddings") -> None:
-        # Create save directory if it doesn't exist
-        os.makedirs(save_dir, exist_ok=True)
+    def create_embeddings_and_index(self, 
+                                    contexts: List[str], 
+                                    save_dir: str = "embeddings", 
+                                    use_cache: bool = True, 
+                                    index_type: str = "auto", 
+                                    refine: bool = False, 
+                                    index_path: Optional[str] = None, 
+                                    contexts_path: Optional[str] = None) -> None:
+        # Callers passing pre-resolved paths have already created the directory
+        if index_path is None or contexts_path is None:
+            os.makedirs(save_dir, exist_ok=True)
         
-        # Generate embeddings
-        embeddings = self.encode_texts(contexts)
+        # Generate embeddings, reusing cached vectors for unchanged contexts
+        cache_dir = os.path.join(save_dir, "embcache")
+        embeddings = self.encode_texts(contexts, cache_dir=cache_dir, use_cache=use_cache)
         
-        # Build FAISS index
-        self.build_faiss_index(embeddings)
+        # Build FAISS index; encode_texts output (cached or fresh) is already unit-length
+        self.build_faiss_index(embeddings, index_type=index_type, refine=refine, 
+                               normalized=self.outputs_normalized)
         
         # Save index and contexts
-        index_path = os.path.join(save_dir, "faiss_index.index")
-        contexts_path = os.path.join(save_dir, "contexts.pkl")
+        index_path = index_path or os.path.join(save_dir, "faiss_index.index")
+        contexts_path = contexts_path or os.path.join(save_dir, "contexts.arrow")
         self.save_index_and_contexts(index_path, contexts_path, contexts)
 
+class OllamaEmbedding(ArabicEmbedding):
+    """Embeds text with an Ollama model so retrieval and generation share one model."""
+    
+    def __init__(self, 
+                 model_name: str = "gemma3:1b", 
+                 client: Optional[ollama.Client] = None, 
+                 batch_size: Optional[int] = None, 
+                 keep_alive: str = "30m"):
+        super().__init__(model_name, batch_size=batch_size, use_fp16=False)
+        self.client = client or ollama.Client()
+        self.keep_alive = keep_alive
+    
+    def load_model(self) -> None:
+        # The model lives in the Ollama server; nothing to load locally
+        pass
+    
+    def _ensure_model_loaded(self) -> None:
+        pass
+    
+    def is_supported(self) -> bool:
+        try:
+            self._embed(["اختبار"])
+            return True
+        except Exception as e:
+            return False
+    
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        response = self.client.embed(model=self.model_name, input=texts, keep_alive=self.keep_alive)
+        embeddings = np.asarray(response['embeddings'], dtype=np.float32)
+        faiss.normalize_L2(embeddings)
+        return embeddings
+    
+    def encode_text(self, text: str) -> np.ndarray:
+        return self._embed([text])
+    
+    def _embed_batches(self, texts: List[str], batch_size: int) -> np.ndarray:
+        return np.vstack([self._embed(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)])
+
 def main():
     
     # Load dataset
@@ -1,11 +1,29 @@
 import ollama
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator
 import json
 
+# Static instructions shared by every prompt; keeping them as an unchanging
+# prefix lets Ollama reuse its cached prompt evaluation between requests
+_PROMPT_PREFIX = """أنت مساعد ذكي يجيب على الأسئلة باللغة العربية بناءً على السياق المعطى.
+
+التعليمات:
+- اجب على السؤال بناءً على المعلومات الموجودة في السياق فقط
+- إذا لم تجد الإجابة في السياق، قل "لا توجد معلومات كافية في السياق المعطى للإجابة على هذا السؤال"
+- اجعل إجابتك واضحة ومفيدة ومختصرة
+- استخدم اللغة العربية الفصحى
+"""
+
+class GenerationError(Exception):
+    """Raised in place of an answer when Ollama cannot generate one; str() is the user-facing message."""
+
 class OllamaLLMGenerator: 
-    def __init__(self, model_name: str = "gemma3:1b"):
+    def __init__(self, model_name: str = "gemma3:1b", keep_alive: str = "30m"):
         self.model_name = model_name
+        # How long Ollama keeps the model loaded after each request
+        self.keep_alive = keep_alive
         self.client = ollama.Client()
+        self._warmed_up = False
+        self._ready = False
         
     def check_model_availability(self) -> bool:
         try:
@@ -24,6 +42,8 @@ class OllamaLLMGenerator:
             for model in model_list:
                 if hasattr(model, 'name'):
                     available_models.append(model.name)
+                elif hasattr(model, 'model'):
+                    available_models.append(model.model)
                 elif isinstance(model, dict) and 'name' in model:
                     available_models.append(model['name'])
                 elif isinstance(model, dict) and 'model' in model:
@@ -31,7 +51,10 @@ class OllamaLLMGenerator:
                 elif isinstance(model, str):
                     available_models.append(model)
             
-            is_available = any(self.model_name in model for model in available_models)
+            # Exact match; an untagged name refers to the ":latest" tag
+            available_models = set(available_models)
+            is_available = (self.model_name in available_models or 
+                            f"{self.model_name}:latest" in available_models)
             return is_available
         except Exception as e:
             # If there's any error checking availability, return False
@@ -44,34 +67,60 @@ class OllamaLLMGenerator:
         except Exception as e:
             return False
     
-    def ensure_model_ready(self) -> bool:
+    def warm_up(self) -> bool:
+        # A one-token generation loads the model into memory ahead of the first question
+        try:
+            self.client.generate(
+                model=self.model_name,
+                prompt=" ",
+                keep_alive=self.keep_alive,
+                options={'num_predict': 1}
+            )
+            self._warmed_up = True
+            return True
+        except Exception as e:
+            return False
+    
+    def ensure_model_ready(self, force: bool = False) -> bool:
+        # Skip the list round-trip once the model is known to be available
+        if self._ready and not force:
+            return True
+        
         if not self.check_model_availability():
-            return self.pull_model()
+            if not self.pull_model():
+                return False
+        
+        if not self._warmed_up:
+            self.warm_up()
+        
+        self._ready = True
         return True
     
     def create_arabic_prompt(self, context: str, question: str) -> str:
 
-        prompt = f"""أنت مساعد ذكي يجيب على الأسئلة باللغة العربية بناءً على السياق المعطى.
-
-السياق:
-{context}
-
-السؤال: {question}
-
-التعليمات:
-- اجب على السؤال بناءً على المعلومات الموجودة في السياق فقط
-- إذا لم تجد الإجابة في السياق، قل "لا توجد معلومات كافية في السياق المعطى للإجابة على هذا السؤال"
-- اجعل إجابتك واضحة ومفيدة ومختصرة
-- استخدم اللغة العربية الفصحى
-
-الإجابة:"""
+        # Variable parts go last so the prefix stays byte-identical across calls
+        prompt = _PROMPT_PREFIX + "\nالسياق:\n" + context + "\n\nالسؤال: " + question + "\n\nالإجابة:"
         
         return prompt
     
-    def generate_answer(self, context: str, question: str, max_tokens: int = 256, temperature: float = 0.7) -> str:
+    def generate_answer(self, 
+                        context: str, 
+                        question: str, 
+                        max_tokens: int = 256, 
+                        temperature: float = 0.7, 
+                        raise_errors: bool = False) -> str:
+        # With raise_errors, failures raise GenerationError instead of coming back as answer text
+        try:
+            return self._generate_answer(context, question, max_tokens, temperature)
+        except GenerationError as e:
+            if raise_errors:
+                raise
+            return str(e)
+    
+    def _generate_answer(self, context: str, question: str, max_tokens: int, temperature: float) -> str:
         # Ensure model is ready
         if not self.ensure_model_ready():
-            return "عذراً، النموذج غير متاح حالياً. يرجى التأكد من تشغيل Ollama وتحميل النموذج."
+            raise GenerationError("عذراً، النموذج غير متاح حالياً. يرجى التأكد من تشغيل Ollama وتحميل النموذج.")
         
         try:
             # Create prompt
@@ -81,6 +130,7 @@ class OllamaLLMGenerator:
             response = self.client.generate(
                 model=self.model_name,
                 prompt=prompt,
+                keep_alive=self.keep_alive,
                 options={
                     'num_predict': max_tokens,
                     'temperature': temperature,
@@ -96,7 +146,74 @@ class OllamaLLMGenerator:
             
             return answer
         except Exception as e:
-            return f"عذراً، حدث خطأ أثناء توليد الإجابة: {str(e)}"
+            raise GenerationError(f"عذراً، حدث خطأ أثناء توليد الإجابة: {str(e)}") from e
+    
+    def generate_answer_stream(self, 
+                               context: str, 
+                               question: str, 
+                               max_tokens: int = 256, 
+                               temperature: float = 0.7, 
+                               raise_errors: bool = False) -> Iterator[str]:
+        # With raise_errors, failures raise GenerationError (possibly after partial output)
+        # instead of arriving as a final text chunk
+        try:
+            yield from self._generate_answer_stream(context, question, max_tokens, temperature)
+        except GenerationError as e:
+            if raise_errors:
+                raise
+            yield str(e)
+    
+    def _generate_answer_stream(self, 
+                                context: str, 
+                                question: str, 
+                                max_tokens: int, 
+                                temperature: float) -> Iterator[str]:
+        # Ensure model is ready
+        if not self.ensure_model_ready():
+            raise GenerationError("عذراً، النموذج غير متاح حالياً. يرجى التأكد من تشغيل Ollama وتحميل النموذج.")
+        
+        try:
+            prompt = self.create_arabic_prompt(context, question)
+            
+            stream = self.client.generate(
+                model=self.model_name,
+                prompt=prompt,
+                stream=True,
+                keep_alive=self.keep_alive,
+                options={
+                    'num_predict': max_tokens,
+                    'temperature': temperature,
+                    'stop': ['\n\n', 'السؤال:', 'السياق:']
+                }
+            )
+            
+            # Hold back the first tokens until the optional "الإجابة:" prefix can be stripped
+            prefix = 'الإجابة:'
+            pending = ''
+            prefix_checked = False
+            for chunk in stream:
+                piece = chunk['response']
+                if pending is None:
+                    yield piece
+                    continue
+                
+                pending = (pending + piece).lstrip()
+                if not prefix_checked:
+                    if len(pending) < len(prefix) and prefix.startswith(pending):
+                        continue
+                    if pending.startswith(prefix):
+                        pending = pending[len(prefix):].lstrip()
+                    prefix_checked = True
+                
+                # Keep left-stripping until the first non-empty text goes out, matching the blocking path
+                if pending:
+                    yield pending
+                    pending = None
+            
+            if pending:
+                yield pending
+        except Exception as e:
+            raise GenerationError(f"عذراً، حدث خطأ أثناء توليد الإجابة: {str(e)}") from e
     
     def generate_with_metadata(self, context: str, question: str, **kwargs) -> Dict[str, Any]:
 
@@ -121,6 +238,7 @@ class OllamaLLMGenerator:
             response = self.client.chat(
                 model=self.model_name,
                 messages=messages,
+                keep_alive=self.keep_alive,
                 options={
                     'num_predict': max_tokens,
                     'temperature': temperature
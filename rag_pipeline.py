@@ -1,54 +1,235 @@
 import os
-from typing import Dict, Any, Optional
-from data_preparation import load_dataset, prepare_contexts_for_embedding
-from embedding import ArabicEmbedding
+import copy
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+import faiss
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Iterator, Optional
+from data_preparation import load_dataset, prepare_contexts_for_embedding, preprocess_text
+from embedding import ArabicEmbedding, OllamaEmbedding
 from retrieval import ContextRetriever
-from llm_generation import OllamaLLMGenerator
+from llm_generation import OllamaLLMGenerator, GenerationError
 
 class RAGPipeline:
     def __init__(self, 
                  model_name: str = "aubmindlab/bert-base-arabertv2",
                  llm_model: str = "gemma3:1b",
-                 embeddings_dir: str = "embeddings"):
+                 embeddings_dir: str = "embeddings",
+                 index_type: str = "auto",
+                 embedding_backend: str = "eager",
+                 cache_size: int = 256,
+                 semantic_threshold: float = 0.97,
+                 semantic_cache_size: int = 1024,
+                 unified_model: bool = False,
+                 min_similarity: float = 0.3,
+                 max_context_chars: int = 2000):
 
         self.model_name = model_name
         self.llm_model = llm_model
-        self.embeddings_dir = embeddings_dir
+        self._set_embeddings_dir(embeddings_dir)
+        self.index_type = index_type
+        self.embedding_backend = embedding_backend
+        
+        # Prompt trimming: drop weak matches and cap the context length sent to the LLM
+        self.min_similarity = min_similarity
+        self.max_context_chars = max_context_chars
+        
+        # Exact-match answer cache (LRU)
+        self.cache_size = cache_size
+        self._qa_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        
+        # Generated answers keyed on the exact (contexts, question) prompt inputs
+        self._generation_cache = OrderedDict()
+        
+        # Semantic cache: embeddings of answered questions -> cached results
+        self.sem_threshold = semantic_threshold
+        self.semantic_cache_size = semantic_cache_size
+        self._semcache_index = None
+        self._semcache_vectors = []
+        self._semcache_entries = []
         
         # Initialize components
-        self.embedding_model = ArabicEmbedding(model_name)
-        self.retriever = ContextRetriever(self.embedding_model)
         self.llm_generator = OllamaLLMGenerator(llm_model)
+        self.unified_model = unified_model
+        # The unified-embedding probe runs once; later re-initializations keep the chosen model
+        self._unified_checked = not unified_model
+        if unified_model:
+            # Embed with the generator model itself instead of a separate AraBERT stack;
+            # its vectors live in their own index
+            self.embedding_model = OllamaEmbedding(llm_model, client=self.llm_generator.client)
+            self._set_embeddings_dir(os.path.join(embeddings_dir, "unified"))
+        else:
+            self.embedding_model = ArabicEmbedding(model_name, 
+                                                   backend=embedding_backend, 
+                                                   onnx_dir=os.path.join(embeddings_dir, "onnx"))
+        self.retriever = ContextRetriever(self.embedding_model)
         
         self.is_initialized = False
     
+    def _set_embeddings_dir(self, embeddings_dir: str) -> None:
+        # Resolve artifact paths once instead of on every initialize() call
+        self.embeddings_dir = embeddings_dir
+        self.index_path = os.path.join(embeddings_dir, "faiss_index.index")
+        self.contexts_path = os.path.join(embeddings_dir, "contexts.arrow")
+        os.makedirs(embeddings_dir, exist_ok=True)
+    
     def initialize(self, dataset_path: str = None, force_rebuild: bool = False) -> bool:
+        # Nothing to do if already loaded and no rebuild was requested
+        if self.is_initialized and not force_rebuild and dataset_path is None:
+            return True
+        
         try:
-            index_path = os.path.join(self.embeddings_dir, "faiss_index.index")
-            contexts_path = os.path.join(self.embeddings_dir, "contexts.pkl")
+            # Check LLM availability first; this pulls the model on a fresh install
+            llm_ready = self.llm_generator.ensure_model_ready()
+            
+            # Fall back to the dedicated embedding model only if the LLM is present but cannot embed
+            if not self._unified_checked and llm_ready:
+                self._unified_checked = True
+                if not self.embedding_model.is_supported():
+                    self.unified_model = False
+                    self._set_embeddings_dir(os.path.dirname(self.embeddings_dir))
+                    self.embedding_model = ArabicEmbedding(self.model_name, 
+                                                           backend=self.embedding_backend, 
+                                                           onnx_dir=os.path.join(self.embeddings_dir, "onnx"))
+                    self.retriever = ContextRetriever(self.embedding_model)
             
-            # Check if index exists and force_rebuild is False
-            if not force_rebuild and os.path.exists(index_path) and os.path.exists(contexts_path):
-                self.retriever.load_index(index_path, contexts_path)
+            # Check if index exists and force_rebuild is False; load_index also warms the
+            # embedding model and index so the first question runs at steady-state speed
+            if not force_rebuild and os.path.exists(self.index_path) and os.path.exists(self.contexts_path):
+                self.retriever.load_index(self.index_path, self.contexts_path)
             else:
                 # Load dataset
                 df = load_dataset(dataset_path)
                 contexts = prepare_contexts_for_embedding(df)
                 
                 # Create embeddings and index
-                self.embedding_model.create_embeddings_and_index(contexts, self.embeddings_dir)
+                self.embedding_model.create_embeddings_and_index(
+                    contexts, 
+                    self.embeddings_dir, 
+                    use_cache=not force_rebuild,
+                    index_type=self.index_type,
+                    index_path=self.index_path,
+                    contexts_path=self.contexts_path
+                )
                 
                 # Load the created index
-                self.retriever.load_index(index_path, contexts_path)
+                self.retriever.load_index(self.index_path, self.contexts_path)
             
-            # Check LLM availability
-            self.llm_generator.ensure_model_ready()
+            # Answers cached against a previous index are no longer valid
+            self.clear_cache()
             
             self.is_initialized = True
             return True
         except Exception as e:
             return False
     
+    def _cache_key(self, question: str, top_k: int, max_tokens: int, temperature: float) -> tuple:
+        normalized = unicodedata.normalize('NFKC', preprocess_text(question)).lower()
+        return (normalized, top_k, max_tokens, temperature)
+    
+    def _cache_get(self, key: tuple) -> Optional[Dict[str, Any]]:
+        with self._cache_lock:
+            result = self._qa_cache.get(key)
+            if result is None:
+                return None
+            self._qa_cache.move_to_end(key)
+        
+        result = copy.deepcopy(result)
+        result['cache_hit'] = True
+        return result
+    
+    def _cache_put(self, key: tuple, result: Dict[str, Any]) -> None:
+        if self.cache_size <= 0:
+            return
+        
+        with self._cache_lock:
+            self._qa_cache[key] = copy.deepcopy(result)
+            self._qa_cache.move_to_end(key)
+            while len(self._qa_cache) > self.cache_size:
+                self._qa_cache.popitem(last=False)
+    
+    def _semcache_get(self, query_embedding: np.ndarray, params: tuple) -> Optional[Dict[str, Any]]:
+        with self._cache_lock:
+            if self._semcache_index is None or self._semcache_index.ntotal == 0:
+                return None
+            
+            # Several neighbours, since a match must also share generation params
+            k = min(8, self._semcache_index.ntotal)
+            scores, ids = self._semcache_index.search(query_embedding, k)
+            
+            result = None
+            for score, idx in zip(scores[0], ids[0]):
+                if idx < 0 or score < self.sem_threshold:
+                    break
+                entry_params, entry = self._semcache_entries[idx]
+                if entry_params == params:
+                    result = entry
+                    break
+        
+        if result is None:
+            return None
+        
+        result = copy.deepcopy(result)
+        result['cache_hit'] = True
+        return result
+    
+    def _semcache_put(self, query_embedding: np.ndarray, params: tuple, result: Dict[str, Any]) -> None:
+        if self.semantic_cache_size <= 0:
+            return
+        
+        with self._cache_lock:
+            if self._semcache_index is None:
+                self._semcache_index = faiss.IndexFlatIP(query_embedding.shape[1])
+            
+            self._semcache_vectors.append(query_embedding[0].copy())
+            self._semcache_entries.append((params, copy.deepcopy(result)))
+            
+            if len(self._semcache_entries) > self.semantic_cache_size:
+                # Drop the oldest half and rebuild, so eviction cost is amortized
+                keep = self.semantic_cache_size // 2
+                self._semcache_vectors = self._semcache_vectors[-keep:]
+                self._semcache_entries = self._semcache_entries[-keep:]
+                self._semcache_index.reset()
+                if self._semcache_vectors:
+                    self._semcache_index.add(np.vstack(self._semcache_vectors))
+            else:
+                self._semcache_index.add(query_embedding)
+    
+    def _generation_key(self, combined_context: str, question: str, max_tokens: int, temperature: float) -> tuple:
+        context_hash = hashlib.sha256(combined_context.encode('utf-8')).hexdigest()
+        question_hash = hashlib.sha256(question.encode('utf-8')).hexdigest()
+        return (context_hash, question_hash, max_tokens, temperature)
+    
+    def _generation_get(self, key: tuple) -> Optional[str]:
+        with self._cache_lock:
+            answer = self._generation_cache.get(key)
+            if answer is not None:
+                self._generation_cache.move_to_end(key)
+            return answer
+    
+    def _generation_put(self, key: tuple, answer: str) -> None:
+        if self.cache_size <= 0:
+            return
+        
+        with self._cache_lock:
+            self._generation_cache[key] = answer
+            self._generation_cache.move_to_end(key)
+            while len(self._generation_cache) > self.cache_size:
+                self._generation_cache.popitem(last=False)
+    
+    def clear_cache(self) -> None:
+        with self._cache_lock:
+            self._qa_cache.clear()
+            self._generation_cache.clear()
+            self._semcache_vectors = []
+            self._semcache_entries = []
+            # Drop the index itself; a new embedding model may have a different dimension
+            self._semcache_index = None
+    
     def answer_question(self, 
                        question: str, 
                        top_k: int = 3, 
@@ -61,31 +242,158 @@ class RAGPipeline:
                 'error_message': 'Pipeline not initialized'
             }
         
+        cached, cache_key, query_embedding = self._lookup_cache(question, top_k, max_tokens, temperature)
+        if cached is not None:
+            return cached
+        
         # Step 1: Retrieve relevant contexts
-        retrieved_contexts = self.retriever.retrieve_with_metadata(question, top_k)
+        retrieved_contexts = self.retriever.retrieve_with_embedding(query_embedding, top_k)
+        retrieved_contexts = self._select_contexts(retrieved_contexts)
         
         if not retrieved_contexts:
-            return {
-                'answer': 'لم يتم العثور على سياق ذي صلة بالسؤال.',
-                'question': question,
-                'retrieved_contexts': [],
-                'context_used': '',
-                'error': False
-            }
+            return self._no_context_result(question)
         
         # Step 2: Combine contexts
         combined_context = "\n\n".join([ctx['context'] for ctx in retrieved_contexts])
         
-        # Step 3: Generate answer using LLM
-        answer = self.llm_generator.generate_answer(
-            combined_context, 
-            question, 
-            max_tokens=max_tokens, 
-            temperature=temperature
+        # Step 3: Generate answer using LLM, unless this exact prompt was answered before
+        generation_key = self._generation_key(combined_context, question, max_tokens, temperature)
+        answer = self._generation_get(generation_key)
+        if answer is None:
+            try:
+                answer = self.llm_generator.generate_answer(
+                    combined_context, 
+                    question, 
+                    max_tokens=max_tokens, 
+                    temperature=temperature, 
+                    raise_errors=True
+                )
+            except GenerationError as e:
+                # Failed generations are returned but never cached
+                result = self._build_result(question, str(e), retrieved_contexts, combined_context)
+                result['error'] = True
+                result['error_message'] = str(e)
+                return result
+            self._generation_put(generation_key, answer)
+        
+        result = self._build_result(question, answer, retrieved_contexts, combined_context)
+        self._store_result(cache_key, query_embedding, result)
+        
+        return result
+    
+    def answer_question_stream(self, 
+                               question: str, 
+                               top_k: int = 3, 
+                               max_tokens: int = 256, 
+                               temperature: float = 0.7) -> Iterator[str]:
+        if not self.is_initialized:
+            yield 'النظام غير مهيأ بعد. يرجى تشغيل initialize() أولاً.'
+            return
+        
+        cached, cache_key, query_embedding = self._lookup_cache(question, top_k, max_tokens, temperature)
+        if cached is not None:
+            yield cached['answer']
+            return
+        
+        # Retrieve once, then stream the answer as the LLM produces it
+        retrieved_contexts = self.retriever.retrieve_with_embedding(query_embedding, top_k)
+        retrieved_contexts = self._select_contexts(retrieved_contexts)
+        
+        if not retrieved_contexts:
+            yield self._no_context_result(question)['answer']
+            return
+        
+        combined_context = "\n\n".join([ctx['context'] for ctx in retrieved_contexts])
+        
+        generation_key = self._generation_key(combined_context, question, max_tokens, temperature)
+        answer = self._generation_get(generation_key)
+        if answer is not None:
+            yield answer
+        else:
+            chunks = []
+            try:
+                for chunk in self.llm_generator.generate_answer_stream(
+                    combined_context, 
+                    question, 
+                    max_tokens=max_tokens, 
+                    temperature=temperature, 
+                    raise_errors=True
+                ):
+                    chunks.append(chunk)
+                    yield chunk
+            except GenerationError as e:
+                # Show the failure after any partial output, and cache nothing
+                yield str(e)
+                return
+            
+            answer = "".join(chunks).strip()
+            self._generation_put(generation_key, answer)
+        
+        result = self._build_result(question, answer, retrieved_contexts, combined_context)
+        self._store_result(cache_key, query_embedding, result)
+    
+    def _select_contexts(self, retrieved_contexts: list) -> list:
+        if not retrieved_contexts:
+            return retrieved_contexts
+        
+        # Similarity floor over all results at once
+        similarities = np.fromiter(
+            (ctx['similarity'] for ctx in retrieved_contexts), 
+            dtype=np.float32, 
+            count=len(retrieved_contexts)
         )
+        keep = np.flatnonzero(similarities >= self.min_similarity)
+        
+        # Greedily fill the character budget in rank order; the best match is always kept
+        selected = []
+        total_chars = 0
+        for i in keep:
+            context = retrieved_contexts[i]
+            total_chars += len(context['context'])
+            if selected and total_chars > self.max_context_chars:
+                break
+            selected.append(context)
+        
+        return selected
+    
+    def _lookup_cache(self, question: str, top_k: int, max_tokens: int, temperature: float) -> tuple:
+        # Serve repeated questions from the cache
+        cache_key = self._cache_key(question, top_k, max_tokens, temperature)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            cached['question'] = question
+            return cached, cache_key, None
+        
+        # Embed the question once; the vector serves both cache lookup and retrieval
+        query_embedding = self.retriever.encode_query(question)
         
-        # Prepare result
-        result = {
+        # Fall back to near-duplicate (paraphrased) questions
+        cached = self._semcache_get(query_embedding, cache_key[1:])
+        if cached is not None:
+            cached['question'] = question
+            self._cache_put(cache_key, cached)
+        
+        return cached, cache_key, query_embedding
+    
+    def _store_result(self, cache_key: tuple, query_embedding: np.ndarray, result: Dict[str, Any]) -> None:
+        self._cache_put(cache_key, result)
+        self._semcache_put(query_embedding, cache_key[1:], result)
+    
+    def _no_context_result(self, question: str) -> Dict[str, Any]:
+        return {
+            'answer': 'لم يتم العثور على سياق ذي صلة بالسؤال.',
+            'question': question,
+            'retrieved_contexts': [],
+            'context_used': '',
+            'error': False
+        }
+    
+    def _build_result(self, 
+                      question: str, 
+                      answer: str, 
+                      retrieved_contexts: list, 
+                      combined_context: str) -> Dict[str, Any]:
+        return {
             'answer': answer,
             'question': question,
             'retrieved_contexts': retrieved_contexts,
@@ -93,23 +401,34 @@ class RAGPipeline:
             'num_contexts_retrieved': len(retrieved_contexts),
             'top_similarity': retrieved_contexts[0]['similarity'] if retrieved_contexts else 0.0,
             'llm_model': self.llm_model,
+            'cache_hit': False,
             'error': False
         }
-        
-        return result
     
-    def batch_answer_questions(self, questions: list, **kwargs) -> list:
-
+    def batch_answer_questions(self, questions: list, max_workers: int = 8, **kwargs) -> list:
+        if not questions:
+            return []
+        
+        # Answer each distinct question once, concurrently: FAISS search and the
+        # Ollama HTTP call both release the GIL, and the caches are lock-protected
+        unique_questions = list(dict.fromkeys(questions))
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_questions))) as executor:
+            unique_results = list(executor.map(lambda q: self.answer_question(q, **kwargs), unique_questions))
+        answers = dict(zip(unique_questions, unique_results))
+        
+        # Map results back to input order
         results = []
-        for i, question in enumerate(questions):
-            result = self.answer_question(question, **kwargs)
-            results.append(result)
+        seen = set()
+        for question in questions:
+            result = answers[question]
+            results.append(copy.deepcopy(result) if question in seen else result)
+            seen.add(question)
         
         return results
     
     def get_pipeline_info(self) -> Dict[str, Any]:
         info = {
-            'embedding_model': self.model_name,
+            'embedding_model': self.llm_model if self.unified_model else self.model_name,
             'llm_model': self.llm_model,
             'embeddings_dir': self.embeddings_dir,
             'is_initialized': self.is_initialized,
@@ -1,61 +1,177 @@
 import numpy as np
 import faiss
-from typing import List, Tuple
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, Dict
 from embedding import ArabicEmbedding
 import os
 
+# Relevance labels by similarity band: <= 0.6, <= 0.8, > 0.8
+_THRESH = np.array([0.6, 0.8])
+_LABELS = ('منخفض', 'متوسط', 'عالي')
+_NO_CONTEXT = "لم يتم العثور على سياق ذي صلة."
+
+
+def _filter_hits(similarities: np.ndarray, indices: np.ndarray, n_ctx: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Drop empty slots (FAISS pads with -1) and hits past the stored contexts,
+    # returning parallel (indices, similarities) arrays
+    valid = (indices >= 0) & (indices < n_ctx)
+    return indices[valid], similarities[valid]
+
 
 class ContextRetriever:    
-    def __init__(self, embedding_model: ArabicEmbedding = None):
+    def __init__(self, embedding_model: ArabicEmbedding = None, query_cache_size: int = 4096):
         self.embedding_model = embedding_model or ArabicEmbedding()
         
-    def load_index(self, index_path: str, contexts_path: str) -> None:
+        # LRU of normalized query embeddings keyed by a hash of the normalized query
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self._query_cache_hits = 0
+        self._query_cache_misses = 0
+        
+    def load_index(self, index_path: str, contexts_path: str, warmup: bool = True) -> None:
         self.embedding_model.load_index_and_contexts(index_path, contexts_path)
+        
+        if warmup:
+            self.warm_up()
+    
+    def warm_up(self) -> None:
+        # Load the tokenizer/model and run one encode so the first query skips that cost
+        self.embedding_model.warm_up()
+        
+        # A dummy search faults the (possibly memory-mapped) index pages into the page cache
+        dummy = np.zeros((1, self.embedding_model.index.d), dtype=np.float32)
+        dummy[0, 0] = 1.0
+        self.embedding_model.search(dummy, 1)
+    
+    def encode_query(self, query: str) -> np.ndarray:
+        key = hashlib.blake2b(query.strip().lower().encode('utf-8'), digest_size=16).hexdigest()
+        with self._query_cache_lock:
+            query_embedding = self._query_cache.get(key)
+            if query_embedding is not None:
+                self._query_cache.move_to_end(key)
+                self._query_cache_hits += 1
+                return query_embedding
+            self._query_cache_misses += 1
+        
+        # Generate embedding for the query; already (1, d) float32, so no copies are needed
+        query_embedding = self.embedding_model.encode_text(query)
+        assert query_embedding.dtype == np.float32
+        
+        # Normalize for cosine similarity, in place, unless the model already did
+        if not self.embedding_model.outputs_normalized:
+            faiss.normalize_L2(query_embedding)
+        
+        # Cached vectors are shared between callers, so keep them immutable
+        query_embedding.setflags(write=False)
+        if self.query_cache_size > 0:
+            with self._query_cache_lock:
+                self._query_cache[key] = query_embedding
+                while len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.popitem(last=False)
+        
+        return query_embedding
+    
+    def cache_stats(self) -> Dict[str, float]:
+        with self._query_cache_lock:
+            lookups = self._query_cache_hits + self._query_cache_misses
+            return {
+                'hits': self._query_cache_hits,
+                'misses': self._query_cache_misses,
+                'size': len(self._query_cache),
+                'hit_ratio': self._query_cache_hits / lookups if lookups else 0.0
+            }
     
     def retrieve_contexts(self, query: str, top_k: int = 3) -> List[Tuple[str, float]]:
+        return self.retrieve_contexts_by_embedding(self.encode_query(query), top_k)
+    
+    def retrieve_contexts_by_embedding(self, query_embedding: np.ndarray, top_k: int = 3) -> List[Tuple[str, float]]:
+        return self._assemble(*self._retrieve_arrays(query_embedding, top_k))
+    
+    def _retrieve_arrays(self, query_embedding: np.ndarray, top_k: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+        # query_embedding must already be a normalized float32 array of shape (1, d)
         if self.embedding_model.index is None or self.embedding_model.contexts is None:
             raise ValueError("Index and contexts must be loaded first")
         
-        # Generate embedding for the query
-        query_embedding = self.embedding_model.encode_text(query)
-        query_embedding = query_embedding.reshape(1, -1).astype(np.float32)
+        # Search in the index
+        similarities, indices = self.embedding_model.search(query_embedding, top_k)
         
-        # Normalize for cosine similarity
-        faiss.normalize_L2(query_embedding)
+        return _filter_hits(similarities[0], indices[0], len(self.embedding_model.contexts))
+    
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        # One batched forward pass for all queries
+        query_embeddings = np.ascontiguousarray(self.embedding_model.encode_texts(queries), dtype=np.float32)
         
-        # Search in the index
-        similarities, indices = self.embedding_model.index.search(query_embedding, top_k)
+        # Normalize for cosine similarity unless the model already did
+        if not self.embedding_model.outputs_normalized:
+            faiss.normalize_L2(query_embeddings)
         
-        # Prepare results
-        retrieved_contexts = []
-        for i, (similarity, idx) in enumerate(zip(similarities[0], indices[0])):
-            if idx < len(self.embedding_model.contexts):
-                context = self.embedding_model.contexts[idx]
-                retrieved_contexts.append((context, float(similarity)))
+        return query_embeddings
+    
+    def retrieve_contexts_batch(self, queries: List[str], top_k: int = 3) -> List[List[Tuple[str, float]]]:
+        return [self._assemble(kept_indices, kept_similarities) 
+                for kept_indices, kept_similarities in self._retrieve_arrays_batch(queries, top_k)]
+    
+    def _retrieve_arrays_batch(self, queries: List[str], top_k: int = 3) -> List[Tuple[np.ndarray, np.ndarray]]:
+        if self.embedding_model.index is None or self.embedding_model.contexts is None:
+            raise ValueError("Index and contexts must be loaded first")
+        
+        if not queries:
+            return []
         
-        return retrieved_contexts
+        # A single (B, d) search: FAISS spreads the rows over its OpenMP threads (a one-row flat
+        # search cannot be split), and GPU indexes only pay off with batched queries
+        similarities, indices = self.embedding_model.search(self.encode_queries(queries), top_k)
+        
+        num_contexts = len(self.embedding_model.contexts)
+        return [_filter_hits(row_similarities, row_indices, num_contexts) 
+                for row_similarities, row_indices in zip(similarities, indices)]
+    
+    def _assemble(self, kept_indices: np.ndarray, kept_similarities: np.ndarray) -> List[Tuple[str, float]]:
+        contexts = self.embedding_model.contexts
+        
+        # Gather kept hits; tolist() yields plain ints/floats in one step
+        return [(contexts[idx], similarity) 
+                for idx, similarity in zip(kept_indices.tolist(), kept_similarities.tolist())]
     
     def retrieve_context_text(self, query: str, top_k: int = 3) -> str:
         retrieved_contexts = self.retrieve_contexts(query, top_k)
         
         if not retrieved_contexts:
-            return "لم يتم العثور على سياق ذي صلة."
+            return _NO_CONTEXT
         
         # Combine contexts
-        combined_context = "\n\n".join([context for context, _ in retrieved_contexts])
+        combined_context = "\n\n".join(context for context, _ in retrieved_contexts)
         
         return combined_context
     
     def retrieve_with_metadata(self, query: str, top_k: int = 3) -> List[dict]:
-        retrieved_contexts = self.retrieve_contexts(query, top_k)
+        return self.retrieve_with_embedding(self.encode_query(query), top_k)
+    
+    def retrieve_with_embedding(self, query_embedding: np.ndarray, top_k: int = 3) -> List[dict]:
+        # Label straight from the hit arrays, skipping the intermediate tuple list
+        return self._with_metadata(*self._retrieve_arrays(query_embedding, top_k))
+    
+    def retrieve_with_metadata_batch(self, queries: List[str], top_k: int = 3) -> List[List[dict]]:
+        return [self._with_metadata(kept_indices, kept_similarities) 
+                for kept_indices, kept_similarities in self._retrieve_arrays_batch(queries, top_k)]
+    
+    def _with_metadata(self, kept_indices: np.ndarray, kept_similarities: np.ndarray) -> List[dict]:
+        contexts = self.embedding_model.contexts
+        
+        # Label every result at once; a score equal to a threshold falls in the lower band
+        levels = np.searchsorted(_THRESH, kept_similarities.astype(np.float64))
         
         results = []
-        for rank, (context, similarity) in enumerate(retrieved_contexts, 1):
+        for rank, (idx, similarity, level) in enumerate(
+                zip(kept_indices.tolist(), kept_similarities.tolist(), levels.tolist()), 1):
             results.append({
                 'rank': rank,
-                'context': context,
+                'context': contexts[idx],
                 'similarity': similarity,
-                'relevance': 'عالي' if similarity > 0.8 else 'متوسط' if similarity > 0.6 else 'منخفض'
+                'relevance': _LABELS[level]
             })
         
         return results
@@ -67,7 +183,7 @@ def main():
     
     # Load index (assuming it exists)
     index_path = "embeddings/faiss_index.index"
-    contexts_path = "embeddings/contexts.pkl"
+    contexts_path = "embeddings/contexts.arrow"
     
     if os.path.exists(index_path) and os.path.exists(contexts_path):
         retriever.load_index(index_path, contexts_path)
@@ -79,13 +195,13 @@ def main():
             "متى تم بناء الهرم الأكبر؟"
         ]
         
-        for query in test_queries:
+        # Retrieve contexts for all queries in one batch
+        batch_results = retriever.retrieve_with_metadata_batch(test_queries, top_k=2)
+        
+        for query, contexts in zip(test_queries, batch_results):
             print(f"\nاستعلام: {query}")
             print("-" * 50)
             
-            # Retrieve contexts
-            contexts = retriever.retrieve_with_metadata(query, top_k=2)
-            
             for result in contexts:
                 print(f"الترتيب: {result['rank']}")
                 print(f"التشابه: {result['similarity']:.4f}")